@@ -1,37 +1,66 @@
-from dotenv import load_dotenv
-from fastapi.middleware.cors import CORSMiddleware
-import firebase_admin
-from fastapi import FastAPI
-import firebase_admin
-from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import base64
+import hashlib
+import json
+import logging
 import os
 import pathlib
+import time
 from functools import lru_cache
 from typing import Annotated, Optional
+
+import cachecontrol
+import firebase_admin
+import google.auth.transport.requests
+import requests
+from cachecontrol.caches import FileCache
+from cachetools import TLRUCache
 from dotenv import load_dotenv
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from firebase_admin import _token_gen, auth
 from firebase_admin.auth import verify_id_token
-from pydantic_settings import BaseSettings
-from sqlalchemy import create_engine
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from firebase_admin.auth import verify_id_token
-from pydantic_settings import BaseSettings
-from sqlalchemy import create_engine, Column, String, Integer, Boolean, JSON, ForeignKey
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, EmailStr
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, JSON, String
+from sqlalchemy import event
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
 
 basedir = pathlib.Path(__file__).parents[1]
+# Settings reads .env itself; this is for libraries such as firebase_admin
+# that look up their configuration (e.g. GOOGLE_APPLICATION_CREDENTIALS)
+# in the process environment.
 load_dotenv(basedir / ".env")
+logger = logging.getLogger(__name__)
 bearer_scheme = HTTPBearer(auto_error=False)
 
+# Decoded ID-token claims keyed by a truncated hash of the raw token, so the
+# RSA signature check runs at most once per token every TOKEN_CACHE_TTL
+# seconds. Entries never outlive the token's own "exp" claim. Only touched
+# from the event loop, so it needs no lock.
+TOKEN_CACHE_TTL = 30
+_token_cache = TLRUCache(
+    maxsize=10_000,
+    ttu=lambda _key, claims, now: min(now + TOKEN_CACHE_TTL, claims["exp"]),
+    timer=time.time,
+)
+
 
 class Settings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file=basedir / ".env", extra="ignore", frozen=True
+    )
+
     app_name: str = "tutorly"
-    env: str = os.getenv("ENV", "development")
-    frontend_url: str = os.getenv("FRONTEND_URL", "NA")
+    env: str = "development"
+    frontend_url: str = "NA"
+    firebase_cert_cache_dir: str = ""
+    # Set AUTO_CREATE_TABLES=0 where the schema is managed out of band, so
+    # workers skip the DDL round trips on every cold start.
+    auto_create_tables: bool = True
 
 
 @lru_cache
@@ -40,13 +69,37 @@ def get_settings() -> Settings:
     return Settings()
 
 
-def get_firebase_user_from_token(
+def check_token_claims(id_token: str) -> None:
+    """Rejects malformed, expired or foreign tokens without the RSA check"""
+    header_b64, payload_b64, _ = id_token.split(".")
+    header = json.loads(base64.urlsafe_b64decode(header_b64 + "=="))
+    claims = json.loads(base64.urlsafe_b64decode(payload_b64 + "=="))
+    # Emulator tokens are unsigned, so only real tokens carry alg and kid.
+    if not os.getenv("FIREBASE_AUTH_EMULATOR_HOST") and (
+        header.get("alg") != "RS256" or not header.get("kid")
+    ):
+        raise ValueError("Unexpected token header")
+    if claims["exp"] <= time.time():
+        raise ValueError("Token expired")
+    project_id = firebase_app.project_id
+    if project_id and claims.get("iss") != f"https://securetoken.google.com/{project_id}":
+        raise ValueError("Token issued for another project")
+
+
+async def get_firebase_user_from_token(
     token: Annotated[Optional[HTTPAuthorizationCredentials], Depends(bearer_scheme)],
 ) -> Optional[dict]:
     try:
         if not token:
             raise ValueError("No token")
-        user = verify_id_token(token.credentials)
+        key = hashlib.sha256(token.credentials.encode()).digest()[:16]
+        user = _token_cache.get(key)
+        if user is None:
+            check_token_claims(token.credentials)
+            # Signature checks and certificate refreshes block, so keep them
+            # off the event loop.
+            user = await asyncio.to_thread(verify_id_token, token.credentials)
+            _token_cache[key] = user
         return user
     except Exception:
         raise HTTPException(
@@ -56,38 +109,64 @@ def get_firebase_user_from_token(
         )
 
 
-app = FastAPI()
-
-
-@app.get("/userid")
-async def get_userid(user: Annotated[dict, Depends(get_firebase_user_from_token)]):
-    """gets the firebase connected user"""
-    return {"id": user["uid"]}
-
-
-settings = get_settings()
-origins = [settings.frontend_url]
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+# SQLite allows a single writer at a time, so writes go through a
+# one-connection pool while reads get their own read-only pool and never
+# queue behind a write.
+DATABASE_URL = "sqlite+aiosqlite:///./tutorly.db"
+READ_ONLY_DATABASE_URL = "sqlite+aiosqlite:///file:./tutorly.db?mode=ro&uri=true"
+write_engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=1,
+    max_overflow=0,
+    pool_timeout=30,
+    pool_recycle=3600,
+    pool_pre_ping=True,
+    # Let SQLAlchemy, not the sqlite3 driver, decide when transactions
+    # begin (see begin_immediate below).
+    connect_args={"isolation_level": None},
+)
+read_engine = create_async_engine(
+    READ_ONLY_DATABASE_URL,
+    pool_size=os.cpu_count() or 1,
+    max_overflow=0,
+    pool_timeout=30,
+    pool_recycle=3600,
+    pool_pre_ping=True,
 )
-firebase_admin.initialize_app()
-
-
-def init_db():
-    Base.metadata.create_all(bind=engine)
-
-
-DATABASE_URL = "sqlite:///./tutorly.db"
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
-def init_db():
-    Base.metadata.create_all(bind=engine)
+# Tune every new SQLite connection: WAL lets readers run alongside the
+# writer, and synchronous=NORMAL drops the per-commit fsync to one.
+@event.listens_for(write_engine.sync_engine, "connect")
+@event.listens_for(read_engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in (
+        "journal_mode=WAL",
+        "synchronous=NORMAL",
+        "busy_timeout=5000",
+        "cache_size=-20000",
+        "temp_store=MEMORY",
+        "foreign_keys=ON",
+    ):
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+
+# Take the write lock when a write transaction starts rather than on its
+# first write, so concurrent writers wait on busy_timeout instead of
+# failing with SQLITE_BUSY when upgrading from a read lock.
+@event.listens_for(write_engine.sync_engine, "begin")
+def begin_immediate(conn):
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+WriteSessionLocal = async_sessionmaker(
+    bind=write_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+ReadSessionLocal = async_sessionmaker(
+    bind=read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
 
 
 Base = declarative_base()
@@ -108,21 +187,38 @@ class User(Base):
 class Tutor(Base):
     __tablename__ = "tutors"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    firebase_uid = Column(String, ForeignKey("users.firebase_uid"), nullable=False)
+    firebase_uid = Column(
+        String, ForeignKey("users.firebase_uid"), nullable=False, index=True
+    )
     alma_mater = Column(String)
     credential = Column(String)
     bio = Column(String)
-    subjects = Column(JSON)  # Store list of strings (e.g., ["Math", "Physics"])
-    grades = Column(JSON)  # Store list of ints (e.g., [9, 10, 11])
     tutorStatus = Column(String)
     availability = Column(JSON)  # Could be a JSON blob with time slots or schedule info
 
 
+# Subjects a tutor teaches, one row per subject so tutors can be found by
+# subject through an index instead of scanning a JSON list on every row.
+class TutorSubject(Base):
+    __tablename__ = "tutor_subjects"
+    tutor_id = Column(Integer, ForeignKey("tutors.id"), primary_key=True)
+    subject = Column(String, primary_key=True, index=True)  # e.g., "Math"
+
+
+# Grades a tutor teaches, one row per grade (same layout as TutorSubject).
+class TutorGrade(Base):
+    __tablename__ = "tutor_grades"
+    tutor_id = Column(Integer, ForeignKey("tutors.id"), primary_key=True)
+    grade = Column(Integer, primary_key=True, index=True)  # e.g., 10
+
+
 # Student-specific data, related to a user by firebase_uid.
 class Student(Base):
     __tablename__ = "students"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    firebase_uid = Column(String, ForeignKey("users.firebase_uid"), nullable=False)
+    firebase_uid = Column(
+        String, ForeignKey("users.firebase_uid"), nullable=False, index=True
+    )
     high_school = Column(String)
     grade = Column(Integer)
     bio = Column(String)
@@ -133,9 +229,13 @@ class Student(Base):
 # Session table links tutors and students by their firebase_uid.
 class Session(Base):
     __tablename__ = "sessions"
+    # Also serves plain tutor_id lookups, so tutor_id has no index of its own.
+    __table_args__ = (Index("ix_sessions_tutor_time", "tutor_id", "scheduled_time"),)
     id = Column(Integer, primary_key=True, autoincrement=True)
     tutor_id = Column(String, ForeignKey("users.firebase_uid"), nullable=False)
-    student_id = Column(String, ForeignKey("users.firebase_uid"), nullable=False)
+    student_id = Column(
+        String, ForeignKey("users.firebase_uid"), nullable=False, index=True
+    )
     scheduled_time = Column(Integer)  # e.g., Unix timestamp
     duration = Column(Integer)  # Duration in minutes
     location = Column(
@@ -146,60 +246,130 @@ class Session(Base):
     subject = Column(String)
 
 
-# # Create tables
-Base.metadata.create_all(bind=engine)
+async def init_db():
+    async with write_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+app = FastAPI()
+settings = get_settings()
+origins = [settings.frontend_url]
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=True,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
+)
+firebase_app = firebase_admin.initialize_app()
+
+
+class SharedCertificateFetchRequest(_token_gen.CertificateFetchRequest):
+    """Fetches Google's token-signing certificates through an on-disk HTTP
+    cache, so every worker process reuses a single download until the
+    response's Cache-Control max-age runs out."""
 
+    def __init__(self, cache_dir, timeout_seconds=None):
+        super().__init__(timeout_seconds)
+        self._session = cachecontrol.CacheControl(
+            requests.Session(), cache=FileCache(cache_dir)
+        )
+        self._delegate = google.auth.transport.requests.Request(self._session)
 
-# Dependency to get the database session
-def get_db():
-    db = SessionLocal()
+
+def init_firebase_auth():
+    """Binds the default app's auth client and pre-fetches its certificates"""
+    global verify_id_token
     try:
+        client = auth._get_client(firebase_app)
+        # Call the client directly rather than firebase_admin.auth's
+        # module-level function, which resolves the app and client per call.
+        verify_id_token = client.verify_id_token
+        verifier = client._token_verifier
+        if settings.firebase_cert_cache_dir:
+            verifier.request = SharedCertificateFetchRequest(
+                settings.firebase_cert_cache_dir, verifier.request.timeout_seconds
+            )
+        verifier.request(_token_gen.ID_TOKEN_CERT_URI)
+    except Exception:
+        logger.warning("Could not initialize Firebase auth", exc_info=True)
+
+
+# Create tables (unless disabled) once the event loop is running, and set
+# up token verification so the first authenticated request does not pay
+# for the client setup or the certificate download.
+@app.on_event("startup")
+async def on_startup():
+    if settings.auto_create_tables:
+        await init_db()
+    init_firebase_auth()
+
+
+# Dependencies to get a read/write or read-only database session
+async def get_db_rw():
+    async with WriteSessionLocal() as db:
+        yield db
+
+
+async def get_db_ro():
+    async with ReadSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 # Pydantic model for User data
 class UserCreate(BaseModel):
     first_name: str
     last_name: str
-    email: str
-    profile_photo: str = None
-    cover_photo: str = None
+    email: EmailStr
+    profile_photo: Optional[str] = None
+    cover_photo: Optional[str] = None
 
 
 # Pydantic model for User response
 class UserResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     firebase_uid: str
     first_name: str
     last_name: str
-    profile_photo: str = None
-    cover_photo: str = None
+    profile_photo: Optional[str] = None
+    cover_photo: Optional[str] = None
+
+
+# Pydantic model for the connected user's id
+class UserIdResponse(BaseModel):
+    id: str
 
 
 # API endpoint to create a User
 @app.post("/users", response_model=UserResponse)
 async def create_user(
+    fbuser_data: Annotated[dict, Depends(get_firebase_user_from_token)],
     user_data: UserCreate,
-    db: Session = Depends(get_db),
-    fbuser_data: Annotated[dict, Depends(get_firebase_user_from_token)] = None,
+    db: Annotated[AsyncSession, Depends(get_db_rw)],
 ):
-    existing_user = (
-        db.query(User).filter(User.firebase_uid == fbuser_data["uid"]).first()
+    # Check and insert in one statement: no row comes back when the
+    # firebase_uid is already registered.
+    user = await db.scalar(
+        insert(User)
+        .values(
+            {
+                **user_data.model_dump(),
+                "firebase_uid": fbuser_data["uid"],
+                "email": fbuser_data["email"],
+            }
+        )
+        .on_conflict_do_nothing(index_elements=["firebase_uid"])
+        .returning(User)
     )
-    if existing_user:
+    if user is None:
         raise HTTPException(status_code=400, detail="User already exists")
-    else:
-        user = User(**user_data.model_dump())
-        user.firebase_uid = fbuser_data["uid"]
-        user.email = fbuser_data["email"]
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-        return user
+    await db.commit()
+    return UserResponse.model_validate(user)
 
 
-@app.get("/userid")
+@app.get("/userid", response_model=UserIdResponse)
 async def get_userid(user: Annotated[dict, Depends(get_firebase_user_from_token)]):
     """gets the firebase connected user"""
     return {"id": user["uid"]}